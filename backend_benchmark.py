@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+"""
+DCTIP Backend Benchmarks
+Times the in-process data structures behind hot API paths at production scale (no database required)
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+# server.py reads these at import time; the benchmarks never open a connection
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "dctip_benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+import server  # noqa: E402
+
+def report(name, count, elapsed):
+    """Print a benchmark line"""
+    print(f"   {name:<40} {count:>9,} ops  {elapsed:8.3f}s  {count / elapsed:>12,.0f} ops/s  {elapsed / count * 1e6:9.1f} us/op")
+
+def bench_reputation(orgs, operations):
+    """Decayed reputation leaderboard: contribution writes and leaderboard reads"""
+    print(f"\n🏆 Reputation leaderboard ({orgs:,} organizations)")
+    now = datetime.now(timezone.utc)
+    points = [10, 25, 15, 5]
+
+    start = time.perf_counter()
+    keys = {}
+    for i in range(orgs):
+        earned_at = now - timedelta(days=random.uniform(0, 365))
+        keys[f"org-{i}"] = server.decay_key_for(random.uniform(100, 1000), earned_at)
+    leaderboard = server.ReputationLeaderboard()
+    leaderboard.index = server.IndexableSkipList(sorted(leaderboard._key(org, key) for org, key in keys.items()))
+    leaderboard.keys = {org: leaderboard._key(org, key) for org, key in keys.items()}
+    report("build index", orgs, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(operations):
+        org = f"org-{random.randrange(orgs)}"
+        keys[org] += server.decay_key_for(random.choice(points))
+        leaderboard.update(org, keys[org])
+    report("contribution (decay key + reindex)", operations, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(operations):
+        for _, org in leaderboard.page(0, 20):
+            server.decayed_score(keys[org], now)
+    report("top-20 page with decayed scores", operations, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(operations):
+        leaderboard.rank(f"org-{random.randrange(orgs)}")
+    report("rank of organization", operations, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(operations):
+        leaderboard.around(f"org-{random.randrange(orgs)}", 5)
+    report("around-me window (+/-5)", operations, time.perf_counter() - start)
+
+    # Ordering by decay key must match ordering by current decayed score
+    top = [org for _, org in leaderboard.page(0, 1000)]
+    scores = [server.decayed_score(keys[org], now) for org in top]
+    assert all(a >= b for a, b in zip(scores, scores[1:])), "leaderboard order diverged from decayed scores"
+
+def build_topology(nodes, edges, seed=7):
+    """Random topology with a few compromised hosts and ~5% servers"""
+    rng = np.random.default_rng(seed)
+    graph = server.TopologyGraph()
+    types = rng.choice(["server", "endpoint", "router", "switch", "firewall"], size=nodes, p=[0.05, 0.6, 0.15, 0.15, 0.05])
+    statuses = rng.choice(["active", "compromised", "quarantined"], size=nodes, p=[0.989, 0.001, 0.01])
+    for i in range(nodes):
+        graph.add_node(f"node-{i}", types[i], statuses[i])
+    graph.edge_ids = [f"edge-{e}" for e in range(edges)]
+    graph.edge_index = {edge_id: e for e, edge_id in enumerate(graph.edge_ids)}
+    graph.edge_src = rng.integers(0, nodes, size=edges, dtype=np.int32)
+    graph.edge_dst = rng.integers(0, nodes, size=edges, dtype=np.int32)
+    graph.edge_ok = rng.random(edges) > 0.02
+    graph.edge_weight = rng.choice([1.0, 0.5, 2.0], size=edges, p=[0.8, 0.15, 0.05]).astype(np.float32)
+    return graph
+
+def bench_topology(nodes, edges, operations):
+    """Topology graph: CSR build, incremental edits, BFS queries"""
+    print(f"\n🌐 Topology graph ({nodes:,} nodes, {edges:,} edges)")
+    graph = build_topology(nodes, edges)
+    start = time.perf_counter()
+    graph.build_csr()
+    report("build CSR", 1, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(operations):
+        graph.add_edge(f"new-{i}", f"node-{random.randrange(nodes)}", f"node-{random.randrange(nodes)}", "normal")
+    report("add connection (overlay)", operations, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(operations):
+        graph.remove_edge(f"edge-{random.randrange(edges)}")
+    report("remove connection", operations, time.perf_counter() - start)
+
+    queries = max(1, operations // 100)
+    start = time.perf_counter()
+    for _ in range(queries):
+        graph.blast_radius(f"node-{random.randrange(nodes)}")
+    report("blast radius (full BFS)", queries, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        graph.neighborhood(f"node-{random.randrange(nodes)}", 2)
+    report("2-hop neighborhood", queries, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(queries):
+        graph.version += 1  # defeat the per-version query cache
+        graph.attack_paths(10)
+    report("attack paths (multi-source BFS)", queries, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(operations):
+        graph.attack_paths(10)
+    report("attack paths (unchanged topology)", operations, time.perf_counter() - start)
+
+def bench_risk(nodes, edges):
+    """Risk propagation: cold convergence and warm-started refresh after a status change"""
+    print(f"\n⚠️  Risk propagation ({nodes:,} nodes, {edges:,} edges)")
+    graph = build_topology(nodes, edges)
+    graph.build_csr()
+    risk = server.RiskPropagation(graph)
+
+    start = time.perf_counter()
+    risk.refresh()
+    report(f"cold convergence ({risk.iterations} iterations)", 1, time.perf_counter() - start)
+
+    refreshes = 10
+    start = time.perf_counter()
+    for _ in range(refreshes):
+        graph.set_node_status(f"node-{random.randrange(nodes)}", random.choice(["compromised", "quarantined", "active"]))
+        risk.refresh()
+    report(f"status change refresh ({risk.iterations} iterations)", refreshes, time.perf_counter() - start)
+
+def bench_layout(nodes, edges):
+    """Force-directed layout: full relayout and an incremental pass placing 1% new nodes"""
+    print(f"\n🗺️  Topology layout ({nodes:,} nodes, {edges:,} edges)")
+    rng = np.random.default_rng(7)
+    src = rng.integers(0, nodes, size=edges)
+    dst = rng.integers(0, nodes, size=edges)
+    positions = rng.uniform(0, server.LAYOUT_SPACING * np.sqrt(nodes), size=(nodes, 2))
+
+    start = time.perf_counter()
+    placed = server.compute_force_layout(positions, src, dst, np.ones(nodes, dtype=bool),
+                                         server.LAYOUT_FULL_ITERATIONS, server.LAYOUT_SPACING)
+    report(f"full layout ({server.LAYOUT_FULL_ITERATIONS} iterations)", 1, time.perf_counter() - start)
+
+    movable = rng.random(nodes) < 0.01
+    start = time.perf_counter()
+    server.compute_force_layout(placed, src, dst, movable, server.LAYOUT_INCREMENTAL_ITERATIONS, server.LAYOUT_SPACING)
+    report(f"incremental layout ({server.LAYOUT_INCREMENTAL_ITERATIONS} iterations)", 1, time.perf_counter() - start)
+
+def bench_correlation(threats):
+    """Indicator correlation: union-find ingest and cluster queries"""
+    print(f"\n🔗 Threat correlation ({threats:,} threats)")
+    rng = random.Random(7)
+    categories = ["malware", "phishing", "ddos", "intrusion", "ransomware"]
+    now = datetime.now(timezone.utc)
+    docs = [{
+        "id": f"threat-{i}",
+        "category": rng.choice(categories),
+        "severity": rng.choice(["low", "medium", "high", "critical"]),
+        "detected_at": (now - timedelta(seconds=threats - i)).isoformat(),
+        "source_ip": f"{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}",
+        "target_system": f"host-{rng.randrange(threats)}",
+        "iocs": [f"domain-{rng.randrange(threats * 2)}.example"]
+    } for i in range(threats)]
+
+    index = server.ThreatCorrelationIndex()
+    start = time.perf_counter()
+    for doc in docs:
+        index.ingest(doc)
+    report("ingest (extract + union)", threats, time.perf_counter() - start)
+
+    queries = 1000
+    start = time.perf_counter()
+    for _ in range(queries):
+        index.cluster_of(f"threat-{rng.randrange(threats)}")
+    report("cluster lookup", queries, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(10):
+        index.largest(20)
+    report(f"top-20 clusters ({len(index.clusters):,} clusters)", 10, time.perf_counter() - start)
+
+def campaign_corpus(threats, campaigns, seed=11):
+    """Synthetic threats drawn from campaigns: each keeps most of its campaign's features and
+    swaps a few for noise, so same-campaign pairs have Jaccard similarity around 0.6-0.8"""
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(5000)]
+    categories = ["malware", "phishing", "ddos", "intrusion", "ransomware", "data_breach"]
+    industries = ["healthcare", "finance", "government", "education", "ecommerce", "manufacturing"]
+    bases = [{
+        "words": rng.sample(words, 4),
+        "category": rng.choice(categories),
+        "prefix": f"{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}",
+        "targets": [f"host-{rng.randrange(100000)}" for _ in range(2)],
+        "industry": rng.choice(industries),
+        "iocs": [f"c{c}-{k}.example" for k in range(3)]
+    } for c in range(campaigns)]
+    docs, labels = [], []
+    for i in range(threats):
+        campaign = rng.randrange(campaigns)
+        base = bases[campaign]
+        name_words = [w if rng.random() > 0.15 else rng.choice(words) for w in base["words"]]
+        docs.append({
+            "id": f"threat-{i}",
+            "name": " ".join(name_words),
+            "category": base["category"],
+            "severity": "high",
+            "detected_at": f"2024-01-01T00:00:{i % 60:02d}+00:00",
+            "source_ip": f"{base['prefix']}.{rng.randrange(256)}",
+            "target_system": rng.choice(base["targets"]),
+            "industry_tags": [base["industry"]],
+            "iocs": [ioc for ioc in base["iocs"] if rng.random() > 0.2]
+        })
+        labels.append(campaign)
+    return docs, labels
+
+def bench_minhash(threats, campaigns):
+    """MinHash/LSH: signature throughput, indexing, lookup latency and recall/precision on a campaign corpus"""
+    print(f"\n🧬 MinHash LSH ({threats:,} threats, {campaigns:,} campaigns)")
+    docs, labels = campaign_corpus(threats, campaigns)
+
+    start = time.perf_counter()
+    features = [server.threat_features(doc) for doc in docs]
+    signatures = server.minhash_signatures(features)
+    report("features + signatures (batched)", threats, time.perf_counter() - start)
+
+    index = server.MinHashLSHIndex()
+    start = time.perf_counter()
+    for doc, signature in zip(docs, signatures):
+        index.ingest(doc, signature)
+    report("index + campaign union", threats, time.perf_counter() - start)
+
+    rng = random.Random(3)
+    queries = [rng.randrange(threats) for _ in range(1000)]
+    start = time.perf_counter()
+    results = [index.lookup(docs[q], 10_000) for q in queries]
+    report("similar-threat lookup", len(queries), time.perf_counter() - start)
+
+    # Ground truth: true Jaccard >= threshold; score against every member of the query's campaign
+    members = {}
+    for i, label in enumerate(labels):
+        members.setdefault(label, []).append(i)
+    found, relevant = {0.5: 0, 0.7: 0}, {0.5: 0, 0.7: 0}
+    correct = returned = 0
+    for q, result in zip(queries, results):
+        query = set(features[q])
+        hits = {threat_id for threat_id, _ in result}
+        for i in members[labels[q]]:
+            if i == q:
+                continue
+            jaccard = len(query & set(features[i])) / len(query | set(features[i]))
+            for cutoff in found:
+                if jaccard >= cutoff:
+                    relevant[cutoff] += 1
+                    found[cutoff] += f"threat-{i}" in hits
+        returned += len(hits)
+        correct += sum(1 for threat_id in hits if labels[int(threat_id.split("-")[1])] == labels[q])
+    print("   " + "   ".join(f"recall {found[c] / max(relevant[c], 1):.3f} (Jaccard >= {c})" for c in found)
+          + f"   precision {correct / max(returned, 1):.3f} (same campaign)")
+
+    sizes = [len(c["members"]) for c in index.campaigns.largest(campaigns)]
+    print(f"   {len(index.campaigns.clusters):,} campaigns recovered from {campaigns:,}, largest {sizes[0] if sizes else 0:,} threats")
+
+def bench_sequences(threats):
+    """Sequence detection: event throughput over a shuffled stream with bounded state"""
+    print(f"\n⛓️  Sequence detection ({threats:,} events)")
+    rng = random.Random(5)
+    steps = [("Port Scan", "intrusion"), ("Privilege Escalation", "intrusion"), ("Data Exfiltration", "data_breach"),
+             ("Phishing Email", "phishing"), ("Malware Signature Match", "malware"), ("Ransomware Encryption", "ransomware"),
+             ("DDoS Attack", "ddos")]
+    base = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    docs = []
+    for i in range(threats):
+        name, category = rng.choice(steps)
+        # ~100 events per minute with up to 30 seconds of arrival disorder
+        event_time = base + i * 0.6 + rng.uniform(-30, 0)
+        docs.append({
+            "id": f"threat-{i}",
+            "name": name,
+            "category": category,
+            "detected_at": datetime.fromtimestamp(event_time, timezone.utc).isoformat(),
+            "source_ip": f"10.0.{rng.randrange(16)}.{rng.randrange(256)}",
+            "target_system": f"host-{rng.randrange(2000)}"
+        })
+
+    detector = server.SequenceDetector()
+    peak_state = 0
+    start = time.perf_counter()
+    for i, doc in enumerate(docs):
+        detector.submit(doc)
+        if i % 10_000 == 0:
+            peak_state = max(peak_state, detector.state_size())
+    detector.flush()
+    report("submit (reorder + NFA + eviction)", threats, time.perf_counter() - start)
+    print(f"   {detector.matches:,} matches, {detector.late:,} late, peak {peak_state:,} partial matches")
+
+def bench_analyze(threats):
+    """Pairwise correlation matrix for an analyst's id list (features + Jaccard matmul + top pairs)"""
+    print(f"\n🧮 Correlation matrix ({threats:,} threats)")
+    docs, _ = campaign_corpus(threats, max(1, threats // 50))
+    start = time.perf_counter()
+    feature_sets = [server.correlation_features(doc) for doc in docs]
+    similarity = server.pairwise_jaccard(feature_sets)
+    upper = similarity[np.triu_indices(threats, k=1)]
+    strongest = np.argpartition(-upper, 20)[:20]
+    strongest[np.argsort(-upper[strongest])]
+    report("full analysis", 1, time.perf_counter() - start)
+
+def bench_geoip(ranges, lookups):
+    """GeoIP: vectorized dotted-quad parsing and searchsorted range lookups"""
+    print(f"\n🌍 GeoIP ({ranges:,} ranges)")
+    rng = np.random.default_rng(9)
+    bounds = np.unique(rng.integers(0, 2 ** 32, size=2 * ranges, dtype=np.uint64)).astype(np.uint32)
+    bounds = bounds[:len(bounds) // 2 * 2]
+    count = len(bounds) // 2
+    database = server.GeoIPDatabase()
+    database.arrays = {
+        "starts": bounds[0::2], "ends": bounds[1::2],
+        "country": rng.integers(0, len(server.GEO_COUNTRIES), size=count).astype(np.uint16),
+        "asn": rng.integers(1, 400000, size=count).astype(np.uint32),
+        "latitude": rng.uniform(-60, 70, size=count).astype(np.float32),
+        "longitude": rng.uniform(-180, 180, size=count).astype(np.float32)
+    }
+    database.countries = list(server.GEO_COUNTRIES)
+
+    values = rng.integers(0, 2 ** 32, size=lookups, dtype=np.uint64).astype(np.uint32)
+    start = time.perf_counter()
+    database.lookup(values)
+    report("bulk lookup (searchsorted)", lookups, time.perf_counter() - start)
+
+    ips = [f"{a >> 24}.{(a >> 16) & 255}.{(a >> 8) & 255}.{a & 255}" for a in values[:1_000_000].tolist()]
+    start = time.perf_counter()
+    parsed, valid = server.parse_ipv4(ips)
+    report("parse dotted quads", len(ips), time.perf_counter() - start)
+    assert valid.all() and (parsed == values[:len(ips)]).all()
+
+    threats = [{"source_ip": ip} for ip in ips[:100_000]]
+    start = time.perf_counter()
+    database.annotate(threats)
+    report("annotate threats (parse + lookup + set)", len(threats), time.perf_counter() - start)
+
+def bench_geo_tiles(threats, queries):
+    """Heatmap tiles: multi-precision geohash aggregation and per-viewport cell reads, in memory only.
+    The (precision, latitude, day) index read and the $group stage of read_geo_tiles are emulated
+    with numpy column scans, so the timings are not /geo/tiles latency; the cell counts and payload
+    sizes are the endpoint's own"""
+    import json
+    print(f"\n🗺️  Geohash heatmap tiles ({threats:,} threats over 90 days, in-memory emulation of the tile read)")
+    rng = np.random.default_rng(13)
+    centres = np.array([(lat, lon) for _, lat, lon in server.GEO_COUNTRIES.values()])
+    home = rng.integers(0, len(centres), size=threats)
+    latitudes = np.clip(centres[home, 0] + rng.normal(0, 4, size=threats), -90, 90)
+    longitudes = (centres[home, 1] + rng.normal(0, 6, size=threats) + 180) % 360 - 180
+    today = np.datetime64(datetime.now(timezone.utc).date(), "D")
+    days = today - rng.integers(0, 90, size=threats)
+    severities = rng.integers(1, 5, size=threats)
+
+    start = time.perf_counter()
+    tiles = server.build_geo_tiles(latitudes, longitudes, days, severities)
+    report("build tiles (all precisions)", threats, time.perf_counter() - start)
+    for precision, columns in tiles.items():
+        print(f"      precision {precision}: {len(columns['cells']):>10,} cell-days")
+    centres_by_precision = {p: server.geohash_decode(c["cells"], p) for p, c in tiles.items()}
+
+    views = [
+        ("world, zoom 1, 30 days", (-90, 90, -180, 180), 1, 30),
+        ("continent, zoom 4, 30 days", (35, 70, -10, 40), 4, 30),
+        ("country, zoom 7, 7 days", (47, 55, 5, 15), 7, 7),
+        ("city, zoom 11, 1 day", (50.5, 51.5, 9.8, 11), 11, 1),
+        ("world, zoom 1, 90 days", (-90, 90, -180, 180), 1, 90),
+    ]
+    for label, (min_lat, max_lat, min_lon, max_lon), zoom, span in views:
+        precision = server.geo_tile_precision(zoom)
+        columns = tiles[precision]
+        cell_lat, cell_lon = centres_by_precision[precision]
+        first, last = (today - span + 1).astype(str), today.astype(str)
+        query = server.geo_tile_query(precision, min_lat, max_lat, min_lon, max_lon, first, last)
+        elapsed, size = 0.0, 0
+        for _ in range(queries):
+            started = time.perf_counter()
+            mask = ((cell_lat >= query["latitude"]["$gte"]) & (cell_lat <= query["latitude"]["$lte"])
+                    & (cell_lon >= query["longitude"]["$gte"]) & (cell_lon <= query["longitude"]["$lte"])
+                    & (columns["days"] >= today - span + 1))
+            cells, inverse = np.unique(columns["cells"][mask], return_inverse=True)
+            counts = np.bincount(inverse, weights=columns["count"][mask]).astype(np.int64)
+            weights = np.bincount(inverse, weights=columns["severity"][mask]).astype(np.int64)
+            order = np.argsort(-counts, kind="stable")[:5000]
+            lat, lon = server.geohash_decode(cells[order], precision)
+            rows = [{"_id": cell, "latitude": round(a, 5), "longitude": round(b, 5), "count": count, "severity": weight}
+                    for cell, a, b, count, weight in zip(server.geohash_strings(cells[order], precision).tolist(),
+                                                          lat.tolist(), lon.tolist(), counts[order].tolist(), weights[order].tolist())]
+            size = len(json.dumps(server.geo_tile_payload(rows, precision, first, last)))
+            elapsed += time.perf_counter() - started
+        print(f"   {label:<32} p{precision} {int(mask.sum()):>8,} rows read {len(rows):>6,} cells "
+              f"{size / 1024:>8.1f} KiB {elapsed / queries * 1000:8.1f} ms/query in memory")
+
+def bench_risk_scoring(orgs, devices, nodes):
+    """Risk engine: one vectorized scoring pass over every organization, device and node"""
+    print(f"\n📊 Risk scoring ({orgs:,} organizations, {devices:,} devices, {nodes:,} nodes)")
+    rng = np.random.default_rng(17)
+    today = datetime.now(timezone.utc).date()
+    organizations = [f"org-{i}" for i in range(orgs)]
+    threat_rows = [{
+        "organization_id": organizations[i % orgs] if i % 10 else None,
+        "severity": ("critical", "high", "medium", "low")[i % 4],
+        "day": (today - timedelta(days=int(d))).isoformat(),
+        "count": int(n), "confidence": 0.85
+    } for i, (d, n) in enumerate(zip(rng.integers(0, 30, size=orgs * 8), rng.integers(1, 20, size=orgs * 8)))]
+    statuses = ["online", "online", "online", "warning", "offline", "critical"]
+    device_types = list(server.RISK_DEVICE_TYPE_SURFACE)
+    device_docs = [{
+        "id": f"dev-{i}", "name": f"dev-{i}", "organization_id": organizations[i % orgs],
+        "device_type": device_types[i % len(device_types)], "status": statuses[i % len(statuses)],
+        "firmware_version": ("2.4.1", "2.3.0", "2.4.0")[i % 3],
+        "cpu_usage": float(cpu), "memory_usage": float(mem), "threats_detected": int(det), "threats_blocked": int(det * 0.9)
+    } for i, (cpu, mem, det) in enumerate(zip(rng.uniform(10, 95, devices), rng.uniform(20, 90, devices), rng.integers(0, 50, devices)))]
+    inputs = {
+        "organizations": organizations,
+        "threat_rows": threat_rows,
+        "threat_history": {org: 100 for org in organizations},
+        "controls": {org: {"implemented": 6, "partial": 2, "not_implemented": 4} for org in organizations},
+        "devices": device_docs,
+        "topology": {
+            "ids": [f"node-{i}" for i in range(nodes)], "names": [None] * nodes,
+            "types": [("server", "router", "endpoint", "cloud")[i % 4] for i in range(nodes)],
+            "statuses": [("active", "active", "active", "compromised", "quarantined")[i % 5] for i in range(nodes)],
+            "compromise": rng.uniform(0, 1, nodes), "degree": rng.integers(0, 20, nodes).astype(np.float64),
+            "compromised_nodes": nodes // 5
+        }
+    }
+    entities = orgs + devices + nodes
+
+    start = time.perf_counter()
+    scored = server.score_risk_inputs(inputs)
+    report("score all entities (vectorized)", entities, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for columns in scored.values():
+        server.combine_risk_factors(columns["threat_exposure"], columns["vulnerability_score"],
+                                    columns["attack_surface"], columns["compliance_score"])
+    report("combine weighted factors", entities, time.perf_counter() - start)
+
+def bench_simulation(nodes, edges, trials):
+    """Risk simulation: Monte Carlo what-if batches inline and across the process pool"""
+    import asyncio
+    print(f"\n🎲 Risk simulation ({nodes:,} nodes, {edges:,} edges)")
+    graph = build_topology(nodes, edges)
+    graph.build_csr()
+    server.topology_graph, server.risk_propagation = graph, server.RiskPropagation(graph)
+    today = datetime.now(timezone.utc).date()
+    inputs = {
+        "organizations": ["org-0"],
+        "threat_rows": [{"organization_id": "org-0", "severity": ("critical", "high", "medium", "low")[d % 4],
+                         "day": (today - timedelta(days=d)).isoformat(), "count": 5, "confidence": 0.85} for d in range(30)],
+        "threat_history": {}, "controls": {"org-0": {"implemented": 4, "not_implemented": 8}}, "devices": [],
+        "topology": server.RiskEngine.topology_inputs()
+    }
+    controls = [{"id": f"c{i}", "control_id": f"C-{i}", "status": "implemented" if i < 4 else "not_implemented"} for i in range(12)]
+    scenario = ([f"c{i}" for i in range(4, 9)], [f"node-{i}" for i in range(3)])
+
+    start = time.perf_counter()
+    model, _ = server.risk_simulation_model(inputs, controls, "org-0", *scenario)
+    report("build model", 1, time.perf_counter() - start)
+
+    for label, max_trials, tolerance, budget in [
+        ("converge to 0.1 CI (inline)", trials // 10, 0.1, 30000),
+        ("converge to 0.1 CI", trials, 0.1, 30000),
+        ("fixed trials (process pool)", trials * 5, 1e-9, 30000),
+        ("1s time budget", 10 ** 9, 1e-9, 1000),
+    ]:
+        result = asyncio.run(server.run_risk_simulation(model, max_trials, budget, tolerance, seed=3))
+        report(f"{label}: {result['stopped_by']}{' (pool)' if result['parallel'] else ''}", result["trials"], result["duration_ms"] / 1000)
+        delta = result["network"]["delta"]
+        print(f"      network delta mean {delta['mean']:.3f} ci95 {delta['ci95']} p95 {delta['percentiles']['p95']}")
+
+BENCHMARKS = {
+    "reputation": lambda args: bench_reputation(args.orgs, args.operations),
+    "topology": lambda args: bench_topology(args.nodes, args.edges, args.operations),
+    "risk": lambda args: bench_risk(args.nodes // 2, args.edges // 2),
+    "layout": lambda args: bench_layout(args.nodes // 4, args.edges // 4),
+    "correlation": lambda args: bench_correlation(args.threats),
+    "minhash": lambda args: bench_minhash(args.threats // 5, args.threats // 500),
+    "sequences": lambda args: bench_sequences(args.threats),
+    "analyze": lambda args: bench_analyze(2000),
+    "geoip": lambda args: bench_geoip(500_000, 10_000_000),
+    "tiles": lambda args: bench_geo_tiles(args.threats * 10, 5),
+    "scoring": lambda args: bench_risk_scoring(args.orgs // 100, args.nodes // 2, args.nodes),
+    "simulation": lambda args: bench_simulation(args.nodes // 4, args.edges // 4, 20000),
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run (default: all): {', '.join(BENCHMARKS)}")
+    parser.add_argument("--orgs", type=int, default=1_000_000)
+    parser.add_argument("--operations", type=int, default=100_000)
+    parser.add_argument("--nodes", type=int, default=200_000)
+    parser.add_argument("--edges", type=int, default=1_000_000)
+    parser.add_argument("--threats", type=int, default=1_000_000)
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args)
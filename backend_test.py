@@ -7,6 +7,7 @@ Tests all backend APIs for the Decentralized Cybersecurity Threat Intelligence P
 import requests
 import json
 import sys
+import time
 from datetime import datetime
 import uuid
 
@@ -226,6 +227,65 @@ class DCTIPTester:
         self.log_result("Edge Devices Metrics Summary", False, f"Failed: {response.status_code if response else 'No response'}")
         return False
 
+    def test_edge_devices_heartbeat(self, device_id):
+        """Test batched heartbeat ingestion"""
+        heartbeats = [
+            {"device_id": device_id, "cpu_usage": 40.0 + i, "memory_usage": 55.5, "network_latency": 12.3}
+            for i in range(5)
+        ]
+        response = self.make_request("POST", "/edge-devices/heartbeat", {"heartbeats": heartbeats})
+        
+        if response and response.status_code == 200:
+            data = response.json()
+            if data.get("accepted") == len(heartbeats):
+                self.log_result("Edge Device Heartbeat", True, f"Accepted {data['accepted']} heartbeats, {data['pending_devices']} devices pending flush")
+                return True
+                
+        self.log_result("Edge Device Heartbeat", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
+    def test_edge_devices_metrics_history(self, device_id):
+        """Test rolled-up device metric history"""
+        response = self.make_request("GET", "/edge-devices/metrics/history", params={"device_ids": device_id})
+        
+        if response and response.status_code == 200:
+            data = response.json()
+            if data.get("resolution") in ["1m", "1h", "1d"] and device_id in data.get("series", {}):
+                self.log_result("Edge Metrics History", True, f"Resolution {data['resolution']}, {len(data['series'][device_id])} buckets")
+                return True
+                
+        self.log_result("Edge Metrics History", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
+    def test_edge_devices_status_events(self):
+        """Test device status change events"""
+        response = self.make_request("GET", "/edge-devices/status/events")
+        
+        if response and response.status_code == 200:
+            data = response.json()
+            if isinstance(data, list):
+                self.log_result("Edge Device Status Events", True, f"Retrieved {len(data)} status change events")
+                return True
+                
+        self.log_result("Edge Device Status Events", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
+    def test_edge_devices_commands(self, device_id):
+        """Test device command long-poll and acknowledgement"""
+        response = self.make_request("GET", f"/edge-devices/{device_id}/commands", params={"wait": 1})
+        
+        if response and response.status_code == 200:
+            data = response.json()
+            if "commands" in data:
+                ack = self.make_request("POST", f"/edge-devices/{device_id}/commands/ack",
+                                        data={"command_ids": [c["id"] for c in data["commands"]]})
+                if ack and ack.status_code == 200:
+                    self.log_result("Edge Device Commands", True, f"Fetched and acknowledged {ack.json().get('acknowledged')} commands")
+                    return True
+                
+        self.log_result("Edge Device Commands", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
     def test_ai_suggestions(self):
         """Test get AI suggestions"""
         response = self.make_request("GET", "/ai/suggestions")
@@ -241,12 +301,16 @@ class DCTIPTester:
 
     def test_ai_analyze_threat(self, threat_id):
         """Test AI threat analysis"""
-        response = self.make_request("POST", "/ai/analyze-threat", params={"threat_id": threat_id})
+        response = self.make_request("POST", "/ai/analyze-threat", params={"threat_id": threat_id, "wait": 10})
         
         if response and response.status_code == 200:
-            data = response.json()
-            if "threat_id" in data and "analysis_summary" in data:
-                self.log_result("AI Analyze Threat", True, "AI threat analysis completed successfully")
+            job = response.json()
+            if job.get("status") != "completed":
+                poll = self.make_request("GET", f"/ai/analysis-jobs/{job.get('id')}", params={"wait": 20})
+                job = poll.json() if poll and poll.status_code == 200 else job
+            result = job.get("result") or {}
+            if job.get("status") == "completed" and result.get("threat_id") == threat_id and "analysis_summary" in result:
+                self.log_result("AI Analyze Threat", True, f"AI threat analysis job completed (cached: {job.get('cached')})")
                 return True
                 
         self.log_result("AI Analyze Threat", False, f"Failed: {response.status_code if response else 'No response'}")
@@ -278,6 +342,19 @@ class DCTIPTester:
         self.log_result("Reputation Contribute", False, f"Failed: {response.status_code if response else 'No response'}")
         return False
 
+    def test_reputation_around(self):
+        """Test leaderboard window around the current organization"""
+        response = self.make_request("GET", "/reputation/leaderboard/around", params={"window": 3})
+        
+        if response and response.status_code == 200:
+            data = response.json()
+            if isinstance(data, list) and all("rank" in rep for rep in data):
+                self.log_result("Reputation Around Me", True, f"Retrieved {len(data)} neighbouring organizations")
+                return True
+                
+        self.log_result("Reputation Around Me", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
     def test_network_topology(self):
         """Test get network topology"""
         response = self.make_request("GET", "/network/topology")
@@ -291,6 +368,85 @@ class DCTIPTester:
         self.log_result("Network Topology", False, f"Failed: {response.status_code if response else 'No response'}")
         return False
 
+    def test_network_attack_paths(self):
+        """Test attack path and blast radius queries over a small created topology"""
+        nodes = []
+        for name, node_type, status in [("Test Host", "endpoint", "compromised"), ("Test Router", "router", "active"), ("Test DB", "server", "active")]:
+            response = self.make_request("POST", "/network/nodes", data={"name": name, "node_type": node_type, "ip_address": "10.99.0.1", "status": status})
+            if not response or response.status_code != 200:
+                self.log_result("Network Attack Paths", False, f"Node creation failed: {response.status_code if response else 'No response'}")
+                return False
+            nodes.append(response.json()["id"])
+        for source_id, target_id in [(nodes[0], nodes[1]), (nodes[1], nodes[2])]:
+            self.make_request("POST", "/network/connections", data={"source_id": source_id, "target_id": target_id})
+        
+        paths = self.make_request("GET", "/network/graph/attack-paths")
+        blast = self.make_request("GET", f"/network/graph/blast-radius/{nodes[0]}")
+        
+        for node_id in nodes:
+            self.make_request("DELETE", f"/network/nodes/{node_id}")
+        
+        if paths and paths.status_code == 200 and blast and blast.status_code == 200:
+            reachable = blast.json().get("reachable", 0)
+            if any(p["target_id"] == nodes[2] for p in paths.json().get("paths", [])) and reachable >= 2:
+                self.log_result("Network Attack Paths", True, f"Found attack path to server, blast radius {reachable} nodes")
+                return True
+                
+        self.log_result("Network Attack Paths", False, f"Failed: {paths.status_code if paths else 'No response'}")
+        return False
+
+    def test_network_risk_after_connection_removed(self):
+        """Test that removing a freshly added connection cuts off the risk it propagated"""
+        nodes = []
+        for name, status in [("Risk Source", "compromised"), ("Risk Hop", "active"), ("Risk Leaf", "active")]:
+            response = self.make_request("POST", "/network/nodes", data={"name": name, "node_type": "risk_probe", "ip_address": "10.98.0.1", "status": status})
+            if not response or response.status_code != 200:
+                self.log_result("Network Risk After Removal", False, f"Node creation failed: {response.status_code if response else 'No response'}")
+                return False
+            nodes.append(response.json()["id"])
+        connections = []
+        for source_id, target_id in [(nodes[0], nodes[1]), (nodes[1], nodes[2])]:
+            response = self.make_request("POST", "/network/connections", data={"source_id": source_id, "target_id": target_id})
+            if response and response.status_code == 200:
+                connections.append(response.json()["id"])
+        
+        def risk_scores():
+            response = self.make_request("GET", "/network/nodes", params={"node_type": "risk_probe"})
+            scores = {n["id"]: n.get("risk_score") for n in response.json()} if response and response.status_code == 200 else {}
+            return [scores.get(node_id) for node_id in nodes]
+        
+        before = risk_scores()
+        if connections:
+            self.make_request("DELETE", f"/network/connections/{connections[0]}")
+        after = risk_scores()
+        
+        for node_id in nodes:
+            self.make_request("DELETE", f"/network/nodes/{node_id}")
+        
+        if len(connections) == 2 and (before[1] or 0) > 0 and after[1] == 0 and after[2] == 0:
+            self.log_result("Network Risk After Removal", True, f"Risk before removal {before}, after {after}")
+            return True
+        
+        self.log_result("Network Risk After Removal", False, f"Stale risk after removal: before {before}, after {after}")
+        return False
+
+    def test_network_layout_lod(self):
+        """Test that the layout pass places nodes and the subnet level-of-detail view collapses them"""
+        response = self.make_request("POST", "/network/layout")
+        if not response or response.status_code != 200:
+            self.log_result("Network Layout LOD", False, f"Layout failed: {response.status_code if response else 'No response'}")
+            return False
+        
+        response = self.make_request("GET", "/network/topology", params={"lod": "subnet"})
+        if response and response.status_code == 200:
+            data = response.json()
+            if all(node.get("id", "").startswith("subnet:") and node.get("member_count", 0) >= 1 for node in data.get("nodes", [])):
+                self.log_result("Network Layout LOD", True, f"{len(data['nodes'])} subnet super-nodes, {len(data['connections'])} links")
+                return True
+        
+        self.log_result("Network Layout LOD", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
     def test_threat_feed_live(self):
         """Test get live threat feed"""
         response = self.make_request("GET", "/threat-feed/live")
@@ -342,6 +498,70 @@ class DCTIPTester:
         self.log_result("Threat Clusters", False, f"Failed: {response.status_code if response else 'No response'}")
         return False
 
+    def test_correlation_shared_ioc(self):
+        """Test that threats sharing an IOC land in the same correlation cluster"""
+        ioc = f"campaign-{uuid.uuid4().hex[:8]}.example"
+        threat_ids = []
+        for category in ["phishing", "malware"]:
+            response = self.make_request("POST", "/threats", data={
+                "name": "Correlation Test", "description": "Shared IOC", "severity": "high",
+                "category": category, "iocs": [ioc]
+            })
+            if not response or response.status_code != 200:
+                self.log_result("Correlation Shared IOC", False, f"Threat creation failed: {response.status_code if response else 'No response'}")
+                return False
+            threat_ids.append(response.json()["id"])
+        
+        response = self.make_request("POST", "/correlation/analyze", data=threat_ids)
+        if response and response.status_code == 200:
+            data = response.json()
+            if data.get("same_cluster") and f"IOC: {ioc}" in data.get("shared_indicators", []):
+                self.log_result("Correlation Shared IOC", True, f"Clustered as {data.get('likely_pattern')}")
+                return True
+        
+        self.log_result("Correlation Shared IOC", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
+    def test_correlation_replay(self):
+        """Test that replaying recent threats detects an intrusion -> escalation -> exfiltration chain"""
+        target = f"replay-{uuid.uuid4().hex[:8]}.internal"
+        steps = [("Port Scan Detected", "intrusion"), ("Privilege Escalation", "intrusion"), ("Data Exfiltration Attempt", "data_breach")]
+        threat_ids = []
+        for name, category in steps:
+            response = self.make_request("POST", "/threats", data={
+                "name": name, "description": "Sequence replay test", "severity": "high",
+                "category": category, "target_system": target
+            })
+            if not response or response.status_code != 200:
+                self.log_result("Correlation Replay", False, f"Threat creation failed: {response.status_code if response else 'No response'}")
+                return False
+            threat_ids.append(response.json()["id"])
+        
+        response = self.make_request("POST", "/correlation/replay", params={"since_hours": 1})
+        if response and response.status_code == 200:
+            data = response.json()
+            if any(m["threat_ids"] == threat_ids for m in data.get("matches", [])):
+                self.log_result("Correlation Replay", True, f"{data['match_count']} matches over {data['events']} events")
+                return True
+        
+        self.log_result("Correlation Replay", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
+    def test_geo_tiles(self):
+        """Test pre-aggregated heatmap tiles for a bounding box and zoom level"""
+        params = {"min_lat": 35, "max_lat": 70, "min_lon": -10, "max_lon": 40, "zoom": 4}
+        response = self.make_request("GET", "/geo/tiles", params=params)
+        
+        if response and response.status_code == 200:
+            data = response.json()
+            cells = data.get("cells", {})
+            if data.get("precision") == 3 and len(cells.get("geohash", [])) == len(cells.get("count", [])):
+                self.log_result("Geo Heatmap Tiles", True, f"{len(cells['geohash'])} cells at precision {data['precision']}")
+                return True
+        
+        self.log_result("Geo Heatmap Tiles", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
     def test_geo_threats(self):
         """Test get geographic threats"""
         response = self.make_request("GET", "/geo/threats")
@@ -370,6 +590,10 @@ class DCTIPTester:
     def test_risk_score(self):
         """Test get overall risk score"""
         response = self.make_request("GET", "/risk/score")
+        if response is not None and response.status_code == 404:
+            # A newly registered organization is scored by the engine's next background pass
+            time.sleep(5)
+            response = self.make_request("GET", "/risk/score")
         
         if response and response.status_code == 200:
             data = response.json()
@@ -380,6 +604,48 @@ class DCTIPTester:
         self.log_result("Risk Score", False, f"Failed: {response.status_code if response else 'No response'}")
         return False
 
+    def test_risk_scores_by_entity(self):
+        """Test batch risk scores for edge devices after a forced recalculation"""
+        response = self.make_request("POST", "/risk/recalculate")
+        if not response or response.status_code != 200:
+            self.log_result("Risk Scores By Entity", False, f"Recalculate failed: {response.status_code if response else 'No response'}")
+            return False
+        
+        response = self.make_request("GET", "/risk/scores", params={"entity_type": "edge_device", "limit": 10})
+        if response and response.status_code == 200:
+            scores = response.json()
+            ordered = all(a["overall_score"] >= b["overall_score"] for a, b in zip(scores, scores[1:]))
+            if ordered and all(s["entity_type"] == "edge_device" for s in scores):
+                self.log_result("Risk Scores By Entity", True, f"{len(scores)} device scores, highest first")
+                return True
+        
+        self.log_result("Risk Scores By Entity", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
+    def test_risk_simulation(self):
+        """Test a Monte Carlo what-if run against the caller's compliance controls"""
+        controls = self.make_request("GET", "/compliance/controls")
+        if not controls or controls.status_code != 200 or not controls.json().get("controls"):
+            self.log_result("Risk Simulation", False, "No compliance controls to simulate")
+            return False
+        
+        scenario = {
+            "implement_controls": [c["id"] for c in controls.json()["controls"][:3]],
+            "trials": 20000,
+            "time_budget_ms": 2000,
+            "seed": 7
+        }
+        response = self.make_request("POST", "/risk/simulate", scenario)
+        if response and response.status_code == 200:
+            data = response.json()
+            delta = data["organization"]["delta"]
+            if data["trials"] >= 1000 and delta["mean"] <= 0 and "p95" in delta["percentiles"]:
+                self.log_result("Risk Simulation", True, f"{data['trials']} trials ({data['stopped_by']}), mean delta {delta['mean']}")
+                return True
+        
+        self.log_result("Risk Simulation", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
     def test_risk_analysis(self):
         """Test get risk analysis"""
         response = self.make_request("GET", "/risk/analysis")
@@ -398,13 +664,30 @@ class DCTIPTester:
         
         if response and response.status_code == 200:
             data = response.json()
-            if isinstance(data, list):
+            if isinstance(data, list) and len(data) <= 30:
                 self.log_result("Risk Trends", True, f"Retrieved {len(data)} days of risk trend data")
                 return True
                 
         self.log_result("Risk Trends", False, f"Failed: {response.status_code if response else 'No response'}")
         return False
 
+    def test_risk_trends_downsampled(self):
+        """Test that a one-year trend is backfilled and averaged into at most 90 points"""
+        response = self.make_request("POST", "/risk/snapshots/backfill", params={"days": 365})
+        if not response or response.status_code != 200:
+            self.log_result("Risk Trends (1 year)", False, f"Backfill failed: {response.status_code if response else 'No response'}")
+            return False
+        
+        response = self.make_request("GET", "/risk/trends", params={"days": 365})
+        if response and response.status_code == 200:
+            data = response.json()
+            if isinstance(data, list) and 0 < len(data) <= 90 and all("samples" in point for point in data):
+                self.log_result("Risk Trends (1 year)", True, f"{len(data)} points covering {sum(p['samples'] for p in data)} days")
+                return True
+        
+        self.log_result("Risk Trends (1 year)", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
     def test_dashboard_stats(self):
         """Test get dashboard statistics"""
         response = self.make_request("GET", "/dashboard/stats")
@@ -457,6 +740,72 @@ class DCTIPTester:
         self.log_result("Federated Contributions", False, f"Failed: {response.status_code if response else 'No response'}")
         return False
 
+    def test_federated_privacy(self):
+        """Test privacy accounting for federated models"""
+        response = self.make_request("POST", "/federated/models", {
+            "model_name": "PrivacyTest-FL",
+            "model_type": "anomaly_detection",
+            "noise_multiplier": 1.1,
+            "sampling_rate": 0.05,
+            "target_epsilon": 4.0
+        })
+        if not response or response.status_code != 200:
+            self.log_result("Federated Privacy", False, f"Model creation failed: {response.status_code if response else 'No response'}")
+            return False
+        model_id = response.json()["id"]
+        
+        response = self.make_request("POST", f"/federated/models/{model_id}/rounds", {"steps": 10})
+        if not response or response.status_code != 200 or response.json().get("epsilon_spent", 0) <= 0:
+            self.log_result("Federated Privacy", False, f"Round not charged: {response.status_code if response else 'No response'}")
+            return False
+        
+        # A round this large must exceed the budget and be refused
+        response = self.make_request("POST", f"/federated/models/{model_id}/rounds", {"steps": 100000})
+        if not response or response.status_code != 409:
+            self.log_result("Federated Privacy", False, f"Exhausted budget not enforced: {response.status_code if response else 'No response'}")
+            return False
+        
+        response = self.make_request("GET", "/federated/privacy")
+        if response and response.status_code == 200:
+            budgets = {b["model_id"]: b for b in response.json()}
+            if model_id in budgets and 0 < budgets[model_id]["privacy_budget_remaining"] < 1:
+                self.log_result("Federated Privacy", True, f"Epsilon spent: {budgets[model_id]['epsilon_spent']}")
+                return True
+                
+        self.log_result("Federated Privacy", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
+    def test_federated_async_aggregation(self):
+        """Test buffered asynchronous aggregation of model updates"""
+        response = self.make_request("POST", "/federated/models", {
+            "model_name": "AsyncAgg-FL",
+            "model_type": "intrusion_detection"
+        })
+        if not response or response.status_code != 200:
+            self.log_result("Federated Async Aggregation", False, f"Model creation failed: {response.status_code if response else 'No response'}")
+            return False
+        model_id = response.json()["id"]
+        
+        response = self.make_request("POST", "/federated/contributions", {
+            "model_id": model_id,
+            "base_version": 0,
+            "update": [0.1, -0.2, 0.05],
+            "num_samples": 120
+        })
+        if not response or response.status_code != 200 or response.json().get("queued", 0) < 1:
+            self.log_result("Federated Async Aggregation", False, f"Contribution not buffered: {response.status_code if response else 'No response'}")
+            return False
+        
+        response = self.make_request("GET", "/federated/scheduler/metrics")
+        if response and response.status_code == 200:
+            data = response.json()
+            if "queue_depth" in data and "round_latency_ms" in data:
+                self.log_result("Federated Async Aggregation", True, f"Updates received: {data['updates_received']}, queued: {data['total_queued']}")
+                return True
+                
+        self.log_result("Federated Async Aggregation", False, f"Failed: {response.status_code if response else 'No response'}")
+        return False
+
     # ============== COMPLIANCE CENTER TESTS ==============
 
     def test_compliance_score(self):
@@ -696,7 +1045,12 @@ class DCTIPTester:
         print("\n📡 Edge Device Tests")
         self.test_edge_devices_get_all()
         device_id = self.test_edge_devices_create()
+        if device_id:
+            self.test_edge_devices_heartbeat(device_id)
+            self.test_edge_devices_metrics_history(device_id)
+            self.test_edge_devices_commands(device_id)
         self.test_edge_devices_metrics_summary()
+        self.test_edge_devices_status_events()
         
         # AI and Analytics Tests
         print("\n🤖 AI and Analytics Tests")
@@ -708,10 +1062,14 @@ class DCTIPTester:
         print("\n🏆 Reputation System Tests")
         self.test_reputation_leaderboard()
         self.test_reputation_contribute()
+        self.test_reputation_around()
         
         # Network and Topology Tests
         print("\n🌐 Network Topology Tests")
         self.test_network_topology()
+        self.test_network_attack_paths()
+        self.test_network_risk_after_connection_removed()
+        self.test_network_layout_lod()
         
         # Threat Feed Tests
         print("\n📊 Threat Feed Tests")
@@ -722,17 +1080,23 @@ class DCTIPTester:
         print("\n🔗 Threat Correlation Tests")
         self.test_correlation_patterns()
         self.test_correlation_clusters()
+        self.test_correlation_shared_ioc()
+        self.test_correlation_replay()
         
         # Geographic Tests
         print("\n🗺️ Geographic Threat Tests")
         self.test_geo_threats()
+        self.test_geo_tiles()
         self.test_geo_heatmap()
         
         # Risk Analysis Tests
         print("\n⚠️ Risk Analysis Tests")
         self.test_risk_score()
+        self.test_risk_scores_by_entity()
+        self.test_risk_simulation()
         self.test_risk_analysis()
         self.test_risk_trends()
+        self.test_risk_trends_downsampled()
         
         # Dashboard and Reporting Tests
         print("\n📈 Dashboard Tests")
@@ -746,6 +1110,8 @@ class DCTIPTester:
         print("\n🤝 Federated Learning Tests")
         self.test_federated_models()
         self.test_federated_contributions()
+        self.test_federated_privacy()
+        self.test_federated_async_aggregation()
         
         # Compliance Center Tests
         print("\n📋 Compliance Center Tests")
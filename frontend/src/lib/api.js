@@ -74,6 +74,9 @@ export const incidentAPI = {
 export const federatedAPI = {
   getModels: () => api.get('/federated/models'),
   getContributions: (limit = 50) => api.get(`/federated/contributions?limit=${limit}`),
+  getPrivacyBudgets: () => api.get('/federated/privacy'),
+  submitUpdate: (data) => api.post('/federated/contributions', data),
+  getSchedulerMetrics: () => api.get('/federated/scheduler/metrics'),
 };
 
 // Blockchain APIs
@@ -109,26 +112,43 @@ export const edgeDeviceAPI = {
   getById: (id) => api.get(`/edge-devices/${id}`),
   create: (data) => api.post('/edge-devices', data),
   getMetrics: () => api.get('/edge-devices/metrics/summary'),
+  reportHeartbeats: (heartbeats) => api.post('/edge-devices/heartbeat', { heartbeats }),
+  getStatusEvents: (params) => api.get('/edge-devices/status/events', { params }),
+  getCommands: (deviceId, wait = 25) => api.get(`/edge-devices/${deviceId}/commands`, { params: { wait } }),
+  acknowledgeCommands: (deviceId, commandIds, status = 'acknowledged', result) => api.post(`/edge-devices/${deviceId}/commands/ack`, { command_ids: commandIds, status, result }),
+  getCommandStatus: (incidentId) => api.get('/edge-devices/commands/status', { params: { incident_id: incidentId } }),
+  getMetricsHistory: (deviceIds, params = {}) => api.get('/edge-devices/metrics/history', { params: { device_ids: deviceIds.join(','), ...params } }),
 };
 
 // AI Suggestions APIs
 export const aiAPI = {
   getSuggestions: (params) => api.get('/ai/suggestions', { params }),
-  analyzeThreat: (threatId) => api.post(`/ai/analyze-threat?threat_id=${threatId}`),
+  analyzeThreat: (threatId, wait = 0) => api.post('/ai/analyze-threat', null, { params: { threat_id: threatId, wait } }),
+  getAnalysisJob: (jobId, wait = 0) => api.get(`/ai/analysis-jobs/${jobId}`, { params: { wait } }),
   updateSuggestionStatus: (id, status) => api.put(`/ai/suggestions/${id}/status`, null, { params: { status } }),
 };
 
 // Reputation System APIs
 export const reputationAPI = {
-  getLeaderboard: (limit = 20) => api.get(`/reputation/leaderboard?limit=${limit}`),
+  getLeaderboard: (limit = 20, offset = 0) => api.get('/reputation/leaderboard', { params: { limit, offset } }),
+  getAround: (orgId, window = 5) => api.get('/reputation/leaderboard/around', { params: { org_id: orgId, window } }),
   getOrganization: (orgId) => api.get(`/reputation/${orgId}`),
   contribute: (type) => api.post(`/reputation/contribute?contribution_type=${type}`),
 };
 
 // Network Topology APIs
 export const networkAPI = {
-  getTopology: () => api.get('/network/topology'),
+  getTopology: (sinceVersion, lod) => api.get('/network/topology', { params: { since_version: sinceVersion, lod } }),
+  runLayout: () => api.post('/network/layout'),
   getNodes: (params) => api.get('/network/nodes', { params }),
+  createNode: (data) => api.post('/network/nodes', data),
+  updateNodeStatus: (nodeId, status) => api.put(`/network/nodes/${nodeId}/status`, null, { params: { status } }),
+  deleteNode: (nodeId) => api.delete(`/network/nodes/${nodeId}`),
+  createConnection: (data) => api.post('/network/connections', data),
+  deleteConnection: (connectionId) => api.delete(`/network/connections/${connectionId}`),
+  getBlastRadius: (nodeId, maxHops) => api.get(`/network/graph/blast-radius/${nodeId}`, { params: { max_hops: maxHops } }),
+  getAttackPaths: (limit = 10) => api.get('/network/graph/attack-paths', { params: { limit } }),
+  getNeighborhood: (nodeId, k = 2) => api.get(`/network/graph/neighborhood/${nodeId}`, { params: { k } }),
 };
 
 // Threat Feed APIs
@@ -140,22 +160,33 @@ export const threatFeedAPI = {
 // Threat Correlation APIs
 export const correlationAPI = {
   getPatterns: (params) => api.get('/correlation/patterns', { params }),
-  getClusters: () => api.get('/correlation/clusters'),
+  getClusters: (method) => api.get('/correlation/clusters', { params: { method } }),
+  getSimilar: (threatId, params) => api.get(`/correlation/similar/${threatId}`, { params }),
   analyze: (threatIds) => api.post('/correlation/analyze', threatIds),
+  replay: (sinceHours, persist = false) => api.post('/correlation/replay', null, { params: { since_hours: sinceHours, persist } }),
+  getStreamMetrics: () => api.get('/correlation/stream/metrics'),
 };
 
 // Geographic Threat APIs
 export const geoAPI = {
   getThreats: () => api.get('/geo/threats'),
   getHeatmap: () => api.get('/geo/heatmap'),
+  getTiles: (params) => api.get('/geo/tiles', { params }),
+  rebuildTiles: () => api.post('/geo/tiles/rebuild'),
   getCountryDetails: (countryCode) => api.get(`/geo/country/${countryCode}`),
+  lookup: (ip) => api.get('/geo/lookup', { params: { ip } }),
+  backfill: () => api.post('/geo/backfill'),
 };
 
 // Risk Analysis APIs
 export const riskAPI = {
-  getScore: () => api.get('/risk/score'),
+  getScore: (entityType, entityId) => api.get('/risk/score', { params: { entity_type: entityType, entity_id: entityId } }),
+  getScores: (entityType = 'edge_device', limit = 50) => api.get('/risk/scores', { params: { entity_type: entityType, limit } }),
+  recalculate: () => api.post('/risk/recalculate'),
+  simulate: (scenario) => api.post('/risk/simulate', scenario),
   getAnalysis: () => api.get('/risk/analysis'),
   getTrends: (days = 30) => api.get(`/risk/trends?days=${days}`),
+  backfillSnapshots: (days = 90) => api.post('/risk/snapshots/backfill', null, { params: { days } }),
 };
 
 export default api;
@@ -50,10 +50,33 @@ const NetworkTopology = () => {
   const isDragging = useRef(false);
   const lastPos = useRef({ x: 0, y: 0 });
 
+  const versionRef = useRef(null);
+  // Zoomed out, the server collapses nodes into per-subnet super-nodes
+  const lod = zoom < 0.75 ? 'subnet' : null;
+  const lodRef = useRef(lod);
+
+  const applyDelta = (current, delta) => {
+    const merge = (items, upserts, removedIds) => {
+      const removed = new Set(removedIds);
+      const byId = new Map(items.filter(item => !removed.has(item.id)).map(item => [item.id, item]));
+      upserts.forEach(item => byId.set(item.id, item));
+      return Array.from(byId.values());
+    };
+    return {
+      nodes: merge(current.nodes, [...delta.added_nodes, ...delta.changed_nodes], delta.removed_node_ids),
+      connections: merge(current.connections, [...delta.added_connections, ...delta.changed_connections], delta.removed_connection_ids),
+      stats: delta.stats
+    };
+  };
+
   const fetchTopology = async () => {
     try {
-      const response = await networkAPI.getTopology();
-      setTopology(response.data);
+      // After the first load only the changes since the last seen version are transferred
+      const currentLod = lodRef.current;
+      const response = await networkAPI.getTopology(currentLod ? null : versionRef.current, currentLod);
+      const data = response.data;
+      setTopology(prev => (data.full ? data : applyDelta(prev, data)));
+      versionRef.current = currentLod ? null : data.version;
     } catch (error) {
       console.error('Failed to fetch topology:', error);
     } finally {
@@ -67,6 +90,13 @@ const NetworkTopology = () => {
     return () => clearInterval(interval);
   }, []);
 
+  useEffect(() => {
+    if (lodRef.current === lod) return;
+    lodRef.current = lod;
+    versionRef.current = null;
+    fetchTopology();
+  }, [lod]);
+
   const handleMouseDown = useCallback((e) => {
     isDragging.current = true;
     lastPos.current = { x: e.clientX, y: e.clientY };
@@ -85,7 +115,7 @@ const NetworkTopology = () => {
   }, []);
 
   const handleZoom = (delta) => {
-    setZoom(prev => Math.max(0.5, Math.min(2, prev + delta)));
+    setZoom(prev => Math.max(0.25, Math.min(2, prev + delta)));
   };
 
   const resetView = () => {
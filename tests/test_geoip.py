@@ -0,0 +1,69 @@
+"""In-process tests for IPv4 parsing and the local GeoIP database (no database server required)"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "dctip_test")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import server  # noqa: E402
+
+def test_parse_ipv4_values():
+    values, valid = server.parse_ipv4(["8.8.8.8", "255.255.255.255", "0.0.0.0", "10.0.0.1"])
+    assert valid.tolist() == [True, True, True, True]
+    assert values.tolist() == [0x08080808, 0xFFFFFFFF, 0, 0x0A000001]
+
+def test_parse_ipv4_rejects_malformed_addresses():
+    ips = ["1.2.3.4\n", "1.2.3.\n4", " 1.2.3.4", "1.2.3.256", "1..2.3", "1.2.3.4.5", "a.b.c.d", "١.2.3.4", "", None, "8.8.4.4"]
+    values, valid = server.parse_ipv4(ips)
+    assert valid.tolist() == [False] * 10 + [True]
+    assert int(values[-1]) == 0x08080404
+
+def build_fixture(tmp_path):
+    csv_path = tmp_path / "ranges.csv"
+    csv_path.write_text(
+        "start_ip,end_ip,country_code,asn,latitude,longitude\n"
+        "1.0.0.0,1.0.0.255,AU,13335,-33.494,143.2104\n"
+        "8.8.8.0,8.8.8.255,US,15169,37.751,-97.822\n"
+        "2001:db8::,2001:db8::ffff,US,0,0,0\n"
+        "134743040,134743295,US,15169,,\n"
+        "10.0.0.0,10.255.255.255,-,0,0,0\n"
+    )
+    database = server.GeoIPDatabase(tmp_path / "geoip")
+    assert server.build_geoip_database(str(csv_path), database.directory) == 3
+    assert database.load()
+    return database
+
+def test_geoip_lookup_known_address(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "geoip", build_fixture(tmp_path))
+    result = asyncio.run(server.lookup_ip_geo("8.8.8.8", current_user={}))
+    assert result == {"ip": "8.8.8.8", "country": "US", "asn": 15169, "latitude": 37.751, "longitude": -97.822}
+    
+    # Integer bounds (8.8.4.0/24) fall back to the country centroid
+    result = asyncio.run(server.lookup_ip_geo("8.8.4.4", current_user={}))
+    assert (result["country"], result["asn"]) == ("US", 15169)
+    
+    for ip in ("10.1.2.3", "9.9.9.9", "8.8.8.8\n"):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(server.lookup_ip_geo(ip, current_user={}))
+        assert error.value.status_code == 404
+
+def test_tile_increments_after_rebuild_cutoff_are_held(monkeypatch):
+    monkeypatch.setattr(server, "counters", server.CounterAggregator(1.0))
+    monkeypatch.setattr(server, "geo_tile_rebuild_cutoff", "2026-01-01T00:00:00+00:00")
+    before = {"source_latitude": 52.5, "source_longitude": 13.4, "detected_at": "2025-12-31T23:00:00+00:00",
+              "severity": "high", "geo_located_at": "2025-12-31T23:59:59+00:00"}
+    after = {**before, "geo_located_at": "2026-01-01T00:00:01+00:00"}
+    server.record_geo_tiles([before, after])
+    precisions = len(server.GEO_TILE_PRECISIONS)
+    assert len(server.counters.pending) == len(server.counters.held) == precisions
+    
+    # Releasing merges the held increments into the next flush
+    server._set_geo_tile_rebuild_cutoff(None)
+    assert not server.counters.held
+    assert all(entry["inc"]["count"] == 2 for entry in server.counters.pending.values())
@@ -0,0 +1,40 @@
+"""In-process tests for risk engine change tracking (no database required)"""
+
+import os
+import sys
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "dctip_test")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import server  # noqa: E402
+
+def test_mark_dirty_tracks_changed_entities():
+    engine = server.RiskEngine()
+    engine.dirty = False
+    engine.mark_dirty(organizations=["org-1"])
+    engine.mark_dirty(devices=["dev-1"])
+    engine.mark_dirty(topology=True)
+    assert not engine.dirty
+    assert (engine.dirty_orgs, engine.dirty_devices, engine.dirty_topology) == ({"org-1"}, {"dev-1"}, True)
+    
+    # Unattributed threats touch every organization, and a bare hook means anything may have changed
+    engine.mark_dirty(organizations=[None])
+    assert engine.dirty
+    engine.dirty = False
+    engine.mark_dirty()
+    assert engine.dirty
+
+def test_firmware_outdated_against_fleet_latest():
+    versions = ["2.3.0", "2.4.1", None]
+    assert server.firmware_outdated(versions).tolist() == [True, False, True]
+    # A subset scored against the newest version seen across the whole fleet
+    assert server.firmware_outdated(versions, server.firmware_key("2.5")).tolist() == [True, True, True]
+
+def test_needs_full_pass_when_fleet_inputs_move():
+    engine = server.RiskEngine()
+    engine.latest_firmware, engine.compromised_nodes = server.firmware_key("2.4.1"), 2
+    inputs = {"devices": [{"firmware_version": "2.4.1"}], "topology": {"compromised_nodes": 2}}
+    assert not engine._needs_full_pass(inputs)
+    assert engine._needs_full_pass({**inputs, "devices": [{"firmware_version": "2.5.0"}]})
+    assert engine._needs_full_pass({**inputs, "topology": {"compromised_nodes": 3}})
@@ -0,0 +1,58 @@
+"""In-process tests for the topology graph and risk propagation (no database required)"""
+
+import os
+import sys
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "dctip_test")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+import server  # noqa: E402
+
+def make_store():
+    store = server.TopologyStore(server.TopologyGraph())
+    version = 0
+    def apply(kind, op, element_id, doc=None):
+        nonlocal version
+        version += 1
+        store.apply({"version": version, "kind": kind, "op": op, "id": element_id, "doc": doc})
+    for node_id, status in (("a", "compromised"), ("b", "active"), ("c", "active")):
+        apply("node", "add", node_id, {"id": node_id, "node_type": "server", "status": status})
+    apply("connection", "add", "ab", {"id": "ab", "source_id": "a", "target_id": "b", "connection_type": "normal"})
+    apply("connection", "add", "bc", {"id": "bc", "source_id": "b", "target_id": "c", "connection_type": "normal"})
+    return store, apply
+
+def test_status_change_reuses_propagation_operator():
+    store, apply = make_store()
+    propagation = server.RiskPropagation(store.graph)
+    before = propagation.refresh()
+    operator = propagation.operator
+    structure_version = store.graph.structure_version
+    
+    apply("node", "update", "b", {"id": "b", "node_type": "endpoint", "status": "quarantined"})
+    after = propagation.refresh()
+    
+    assert store.graph.structure_version == structure_version
+    assert propagation.operator is operator
+    assert before[store.graph.node_index["c"]] > 0
+    assert after[store.graph.node_index["c"]] == 0
+
+def test_new_and_revived_nodes_rebuild_propagation_operator():
+    store, apply = make_store()
+    propagation = server.RiskPropagation(store.graph)
+    propagation.refresh()
+    operator = propagation.operator
+    
+    apply("node", "add", "d", {"id": "d", "node_type": "endpoint", "status": "active"})
+    propagation.refresh()
+    assert propagation.operator is not operator
+    
+    operator = propagation.operator
+    apply("node", "remove", "d")
+    propagation.refresh()
+    assert propagation.operator is not operator
+    
+    operator = propagation.operator
+    apply("node", "update", "d", {"id": "d", "node_type": "endpoint", "status": "active"})
+    propagation.refresh()
+    assert propagation.operator is not operator